@@ -0,0 +1,118 @@
+"""Tests for the child spawner lifecycle of WrapSpawner and ProfilesSpawner"""
+
+import asyncio
+import os
+
+from jupyterhub.spawner import LocalProcessSpawner, Spawner
+from traitlets.config import Config
+
+from wrapspawner import ProfilesSpawner
+
+
+class MockUser:
+    name = 'user'
+    escaped_name = 'user'
+    url = '/user/user/'
+
+
+class MockSpawner(Spawner):
+    """A child spawner that keeps no state of its own"""
+
+    started = False
+
+    async def start(self):
+        self.started = True
+        return ('127.0.0.1', 8888)
+
+    async def poll(self):
+        return None
+
+    async def stop(self, now=False):
+        self.started = False
+
+
+def new_spawner(**kwargs):
+    profiles = [
+        ('Local', 'local', LocalProcessSpawner, {}),
+        ('Mock', 'mock', MockSpawner, {'start_timeout': 5}),
+    ]
+    spawner = ProfilesSpawner(config=Config(), profiles=profiles, **kwargs)
+    spawner.user = MockUser()
+    return spawner
+
+
+def test_start_selected_profile():
+    spawner = new_spawner(user_options={'profile': 'mock'})
+    assert asyncio.run(spawner.start()) == ('127.0.0.1', 8888)
+    assert isinstance(spawner.child_spawner, MockSpawner)
+    assert spawner.child_spawner.started
+    assert spawner.child_spawner.start_timeout == 5
+
+
+def test_poll_after_load_state():
+    # a server that was running when the Hub restarted must still be seen as running
+    spawner = new_spawner(user_options={'profile': 'local'})
+    spawner.load_state({'profile': 'local', 'child_conf': {}, 'child_state': {'pid': os.getpid()}})
+    assert spawner.child_spawner is None
+    assert asyncio.run(spawner.poll()) is None
+    assert spawner.child_spawner.pid == os.getpid()
+
+
+def test_poll_without_state():
+    spawner = new_spawner()
+    assert asyncio.run(spawner.poll()) == 1
+    assert spawner.child_spawner is None
+
+
+def test_poll_stateless_child_after_load_state():
+    # a child that keeps no state of its own may still be running after a Hub restart
+    spawner = new_spawner(user_options={'profile': 'mock'})
+    spawner.load_state({'profile': 'mock', 'child_conf': {}})
+    assert asyncio.run(spawner.poll()) is None
+    assert isinstance(spawner.child_spawner, MockSpawner)
+
+
+def test_state_round_trip_stateless_child():
+    spawner = new_spawner(user_options={'profile': 'mock'})
+    asyncio.run(spawner.start())
+    state = spawner.get_state()
+    assert state['child_state'] == {}
+
+    restored = new_spawner(user_options={'profile': 'mock'})
+    restored.load_state(state)
+    assert asyncio.run(restored.poll()) is None
+
+
+def test_form_cache_is_bounded():
+    for i in range(ProfilesSpawner._form_cache_size + 5):
+        spawner = ProfilesSpawner(config=Config(), profiles=[('Local %i' % i, 'local', LocalProcessSpawner, {})])
+        assert 'Local %i' % i in spawner.options_form
+    assert len(ProfilesSpawner._form_cache) == ProfilesSpawner._form_cache_size
+
+
+class PropertyProfilesSpawner(ProfilesSpawner):
+    """Offers profiles computed on every access, like DockerProfilesSpawner"""
+
+    extra_profiles = []
+
+    @property
+    def profiles(self):
+        return [('Local', 'local', LocalProcessSpawner, {})] + self.extra_profiles
+
+
+def test_select_profile_from_property():
+    spawner = PropertyProfilesSpawner(config=Config())
+    spawner.select_profile('mock')
+    assert spawner.child_class is LocalProcessSpawner
+
+    spawner.extra_profiles = [('Mock', 'mock', MockSpawner, {})]
+    spawner.select_profile('mock')
+    assert spawner.child_class is MockSpawner
+
+
+def test_select_profile_after_in_place_change():
+    spawner = ProfilesSpawner(config=Config(), profiles=[('Local', 'local', LocalProcessSpawner, {})])
+    spawner.select_profile('local')
+    spawner.profiles.append(('Mock', 'mock', MockSpawner, {}))
+    spawner.select_profile('mock')
+    assert spawner.child_class is MockSpawner
@@ -6,7 +6,7 @@
 WrapSpawner provides a mechanism to wrap the interface of a Spawner such that
 the Spawner class to use for single-user servers can be chosen dynamically.
 The child Spawner is created and started using the same logic as in User.spawn(),
-but not until start() or load_state() is called. Thus, subclasses may modify the
+but not until the first call to start(), stop() or poll(). Thus, subclasses may modify the
 class or properties of the child Spawner at any earlier point (e.g. from
 Authenticator pre_spawn hooks or options form processing).
 
@@ -20,29 +20,57 @@ Using this mechanism, the administrator can provide users with a pre-approved
 selection of Spawner configurations.
 """
 
+import asyncio
+import functools
 import json
 import re
+import string
+import time
 import urllib.request
+from collections import Counter, OrderedDict
 
-from tornado import concurrent
+from tornado.httpclient import AsyncHTTPClient, HTTPError
 
 from jupyterhub.spawner import LocalProcessSpawner, Spawner
 from traitlets import (
-    Instance, Type, Tuple, List, Dict, Unicode, Any
+    Instance, Type, Tuple, List, Dict, Unicode, Any, Float
 )
-from traitlets import directional_link, validate, TraitError
-
-# Only needed for DockerProfilesSpawner
-try:
-    import docker
-except ImportError:
-    pass
-
-# Utility to create dummy Futures to return values through yields
-def _yield_val(x=None):
-    f = concurrent.Future()
-    f.set_result(x)
-    return f
+from traitlets import validate, TraitError
+
+_formatter = string.Formatter()
+
+# Utilities to split a str.format template into its literal and field segments once
+# per process, then render it repeatedly without re-parsing the template text
+@functools.lru_cache(maxsize=32)
+def _parse_template(template):
+    return tuple(_formatter.parse(template))
+
+def _render_template(segments, values):
+    parts = []
+    for literal, field, spec, conversion in segments:
+        parts.append(literal)
+        if field is None:
+            continue
+        if field in values:
+            value = values[field]
+        else:
+            value = _formatter.get_field(field, (), values)[0]
+        if conversion:
+            value = _formatter.convert_field(value, conversion)
+        if spec and '{' in spec:
+            spec = _formatter.vformat(spec, (), values)
+        parts.append(format(value, spec))
+    return ''.join(parts)
+
+# Names of the traits defined by both a WrapSpawner class and a child Spawner class,
+# less those the child gets from its own config
+@functools.lru_cache(maxsize=128)
+def _common_traits(parent_cls, child_cls, conf_keys):
+    return (
+        frozenset(parent_cls.class_trait_names()) &
+        frozenset(child_cls.class_trait_names()) -
+        conf_keys
+    )
 
 class WrapSpawner(Spawner):
 
@@ -65,6 +93,15 @@ class WrapSpawner(Spawner):
 
     child_spawner = Instance(Spawner, allow_none=True)
 
+    # traits currently forwarded to child_spawner by _propagate_to_child
+    _linked_traits = ()
+
+    # whether load_state restored a saved state, i.e. a server may still be running
+    _has_saved_state = False
+
+    # whether child_state may be out of date with child_spawner.get_state()
+    _child_state_dirty = True
+
     def construct_child(self):
         if self.child_spawner is None:
             self.child_spawner = self.child_class(
@@ -79,21 +116,33 @@ class WrapSpawner(Spawner):
                 config = self.config,
                 **self.child_config
                 )
-            # initial state will always be wrong since it will see *our* state
-            self.child_spawner.clear_state()
-            if self.child_state:
-                self.child_spawner.load_state(self.child_state)
-
-            # link traits common between self and child
-            common_traits = (
-                set(self.trait_names()) &
-                set(self.child_spawner.trait_names()) -
-                set(self.child_config.keys())
-            )
-            for trait in common_traits:
-                directional_link((self, trait), (self.child_spawner, trait))
+            self._child_state_dirty = True
+            # set up the child with its notifications batched into a single flush
+            with self.child_spawner.hold_trait_notifications():
+                # a freshly constructed child has no state of its own yet, so only restore ours
+                if self.child_state:
+                    self.child_spawner.load_state(self.child_state)
+
+                # link traits common between self and child
+                common_traits = _common_traits(
+                    type(self), type(self.child_spawner), frozenset(self.child_config)
+                )
+                for trait in common_traits:
+                    setattr(self.child_spawner, trait, getattr(self, trait))
+            self._unlink_child()
+            self._linked_traits = tuple(common_traits)
+            self.observe(self._propagate_to_child, names=self._linked_traits)
         return self.child_spawner
 
+    def _propagate_to_child(self, change):
+        if self.child_spawner is not None:
+            setattr(self.child_spawner, change['name'], change['new'])
+
+    def _unlink_child(self):
+        if self._linked_traits:
+            self.unobserve(self._propagate_to_child, names=self._linked_traits)
+            self._linked_traits = ()
+
     def load_child_class(self, state):
         # Subclasses must arrange for correct child_class setting from load_state
         pass
@@ -101,50 +150,78 @@ class WrapSpawner(Spawner):
     def load_state(self, state):
         super().load_state(state)
         self.load_child_class(state)
-        self.child_config.update(state.get('child_conf', {}))
-        self.child_state = state.get('child_state', {})
-        self.construct_child()
+        self._has_saved_state = bool(state)
+        # most users have no server to restore, so leave the empty defaults alone for them
+        child_conf = state.get('child_conf')
+        if child_conf:
+            self.child_config.update(child_conf)
+        child_state = state.get('child_state')
+        if child_state:
+            self.child_state = child_state
+        # the child is only constructed once it is needed, so that restoring every user's
+        # state at Hub startup does not instantiate a child Spawner per user
 
     def get_state(self):
         state = super().get_state()
         state['child_conf'] = self.child_config
-        if self.child_spawner:
-            self.child_state = state['child_state'] = self.child_spawner.get_state()
+        # the child's state only changes through start/stop/poll, so reuse it until one of them ran
+        if self.child_spawner and self._child_state_dirty:
+            self.child_state = self.child_spawner.get_state()
+            self._child_state_dirty = False
+        state['child_state'] = self.child_state
         return state
 
     def clear_state(self):
         super().clear_state()
         if self.child_spawner:
             self.child_spawner.clear_state()
+        self._unlink_child()
+        self._child_state_dirty = True
+        self._has_saved_state = False
         self.child_state = {}
         self.child_config = {}
         self.child_spawner = None
 
     # proxy functions for start/poll/stop
-    # pass back the child's Future, or create a dummy if needed
-
-    def start(self):
-        if not self.child_spawner:
-            self.construct_child()
-        return self.child_spawner.start()
-
-    def stop(self, now=False):
-        if self.child_spawner:
-            return self.child_spawner.stop(now)
+    # pass back the child's result, or a constant if there is no child
+    # after load_state a server may still be running, so construct its child on demand
+
+    async def start(self):
+        child = self.child_spawner
+        if child is None:
+            child = self.construct_child()
+        return await self._track_child_state(child.start())
+
+    async def stop(self, now=False):
+        child = self.child_spawner
+        if child is None and self._has_saved_state:
+            child = self.construct_child()
+        if child is not None:
+            return await self._track_child_state(child.stop(now))
+
+    async def poll(self):
+        child = self.child_spawner
+        if child is None and self._has_saved_state:
+            child = self.construct_child()
+        if child is not None:
+            return await self._track_child_state(child.poll())
         else:
-            return _yield_val()
+            return 1
 
-    def poll(self):
-        if self.child_spawner:
-            return self.child_spawner.poll()
-        else:
-            return _yield_val(1)
+    async def _track_child_state(self, awaitable):
+        # mark the child's state as changed once the call completes, not when it is made,
+        # so that a get_state() while it is pending does not hide the final state
+        try:
+            return await awaitable
+        finally:
+            self._child_state_dirty = True
 
     if hasattr(Spawner, 'progress'):
         @property
         def progress(self):
-            if self.child_spawner:
-                return self.child_spawner.progress
+            child = self.child_spawner
+            if child is not None:
+                return child.progress
             else:
                 raise RuntimeError("No child spawner yet exists - can not get progress yet")
 
@@ -175,9 +252,9 @@ class ProfilesSpawner(WrapSpawner):
     def _validate_profiles(self, proposal):
         profiles = proposal.value
 
-        seen = set()
-        duplicated = {p[1] for p in profiles if p[1] in seen or seen.add(p[1])}
-        if len(duplicated):
+        counts = Counter(key for _, key, _, _ in profiles)
+        duplicated = [key for key, count in counts.items() if count > 1]
+        if duplicated:
             raise TraitError(
                 f"Invalid wrapspawner profiles, profiles keys are not unique : {duplicated}")
 
@@ -211,11 +288,44 @@ class ProfilesSpawner(WrapSpawner):
             the first item starts selected."""
         )
 
+    # rendered options forms shared by all instances, least recently used first
+    _form_cache = OrderedDict()
+    _form_cache_size = 16
+
     def _options_form_default(self):
-        temp_keys = [ dict(display=p[0], key=p[1], type=p[2], first='') for p in self.profiles ]
-        temp_keys[0]['first'] = self.first_template
-        text = ''.join([ self.input_template.format(**tk) for tk in temp_keys ])
-        return self.form_template.format(input_template=text)
+        return self._cached_form(self.profiles)
+
+    def _cached_form(self, profiles):
+        # Only rebuild the form when the offered profiles or the templates changed
+        key = self._form_key(profiles)
+        cache = self._form_cache
+        form = cache.get(key)
+        if form is None:
+            form = cache[key] = self._build_form(profiles)
+            if len(cache) > self._form_cache_size:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(key)
+        return form
+
+    def _form_key(self, profiles):
+        # everything _build_form reads, i.e. the templates and the first three profile fields
+        return (
+            self.form_template, self.input_template, self.first_template,
+            tuple((display, key, cls) for display, key, cls, _ in profiles),
+        )
+
+    def _build_form(self, profiles):
+        input_segments = _parse_template(self.input_template)
+        # a single mapping is updated for each row instead of building a dict per profile
+        values = dict(first=self.first_template)
+        rows = []
+        for display, key, cls, _ in profiles:
+            values['display'], values['key'], values['type'] = display, key, cls
+            rows.append(_render_template(input_segments, values))
+            values['first'] = ''
+        text = ''.join(rows)
+        return _render_template(_parse_template(self.form_template), dict(input_template=text))
 
     def options_from_form(self, formdata):
         # Default to first profile if somehow none is provided
@@ -223,18 +333,21 @@ class ProfilesSpawner(WrapSpawner):
 
     # load/get/clear : save/restore child_profile (and on load, use it to update child class/config)
 
+    def _get_profile_index(self):
+        # profile key -> (Spawner class, config dict). Subclasses may compute profiles in a
+        # property or change the list in place, so always index the current list
+        return {key: (cls, conf) for _, key, cls, conf in self.profiles}
+
     def select_profile(self, profile):
         # Select matching profile, or do nothing (leaving previous or default config in place)
-        for p in self.profiles:
-            if p[1] == profile:
-                self.child_class = p[2]
-                self.child_config = p[3]
-                break
+        cls_conf = self._get_profile_index().get(profile)
+        if cls_conf is not None:
+            self.child_class, self.child_config = cls_conf
 
     def construct_child(self):
         self.child_profile = self.user_options.get('profile', "")
         self.select_profile(self.child_profile)
-        super().construct_child()
+        return super().construct_child()
 
     def load_child_class(self, state):
         try:
@@ -278,21 +391,79 @@ class DockerProfilesSpawner(ProfilesSpawner):
         help = "Args to pass to DockerSpawner."
     )
 
+    nvidia_args_cache_ttl = Float(60.0,
+        config = True,
+        help = """Number of seconds to reuse the arguments fetched from the nvidia-docker plugin
+            before querying it again."""
+    )
+
+    nvidia_args_retry_interval = Float(300.0,
+        config = True,
+        help = """Number of seconds to wait before querying the nvidia-docker plugin again after
+            it could not be reached."""
+    )
+
+    profiles_cache_ttl = Float(30.0,
+        config = True,
+        help = """Number of seconds to reuse the profiles discovered from the docker daemon
+            before listing its images again."""
+    )
+
     jupyterhub_docker_tag_re = re.compile('^.*jupyterhub$')
 
+    nvidia_args_url = 'http://localhost:3476/v1.0/docker/cli/json'
+
+    # seconds to wait for the nvidia-docker plugin, on both the blocking and the async path
+    nvidia_args_timeout = 1.0
+
+    # (timestamp, value) of the last nvidia-docker plugin query, shared by all instances
+    _nvidia_args_cache = None
+
+    def _cached_nvidia_args(self):
+        if self._nvidia_args_cache is not None:
+            timestamp, args = self._nvidia_args_cache
+            # an empty result means the plugin was unreachable, which is not worth retrying soon
+            ttl = self.nvidia_args_cache_ttl if args else self.nvidia_args_retry_interval
+            if time.monotonic() - timestamp < ttl:
+                return args
+        return None
+
     def _nvidia_args(self):
+        args = self._cached_nvidia_args()
+        if args is None:
+            args = self._fetch_nvidia_args()
+            DockerProfilesSpawner._nvidia_args_cache = (time.monotonic(), args)
+        return args
+
+    async def _async_nvidia_args(self):
+        # Same as _nvidia_args, but without blocking the event loop on a cache miss
+        args = self._cached_nvidia_args()
+        if args is None:
+            try:
+                resp = await AsyncHTTPClient().fetch(
+                    self.nvidia_args_url, request_timeout=self.nvidia_args_timeout
+                )
+                args = self._parse_nvidia_args(resp.body.decode('utf-8'))
+            except (HTTPError, OSError):
+                args = {}
+            DockerProfilesSpawner._nvidia_args_cache = (time.monotonic(), args)
+        return args
+
+    def _fetch_nvidia_args(self):
         try:
-            resp = urllib.request.urlopen('http://localhost:3476/v1.0/docker/cli/json')
-            body = resp.read().decode('utf-8')
-            args =  json.loads(body)
-            return dict(
-                read_only_volumes={vol.split(':')[0]: vol.split(':')[1] for vol in args['Volumes']},
-                extra_create_kwargs={"volume_driver": args['VolumeDriver']},
-                extra_host_config={"devices": args['Devices']},
-            )
-        except urllib.error.URLError:
+            resp = urllib.request.urlopen(self.nvidia_args_url, timeout=self.nvidia_args_timeout)
+            return self._parse_nvidia_args(resp.read().decode('utf-8'))
+        except OSError:
+            # URLError, and socket.timeout raised while reading the response
             return {}
 
+    def _parse_nvidia_args(self, body):
+        args =  json.loads(body)
+        return dict(
+            read_only_volumes={vol.split(':')[0]: vol.split(':')[1] for vol in args['Volumes']},
+            extra_create_kwargs={"volume_driver": args['VolumeDriver']},
+            extra_host_config={"devices": args['Devices']},
+        )
 
     def _docker_profile(self, nvidia_args, image):
         spawner_args = dict(container_image=image, network_name=self.user.name)
@@ -301,26 +472,93 @@ class DockerProfilesSpawner(ProfilesSpawner):
         nvidia_enabled = "w/GPU" if len(nvidia_args) > 0 else "no GPU"
         return ("Docker: (%s): %s"%(nvidia_enabled, image), "docker-%s"%(image), "dockerspawner.SystemUserSpawner", spawner_args)
 
+    # docker module, only imported once a DockerProfilesSpawner actually needs it
+    _docker = None
+
+    def _docker_module(self):
+        if DockerProfilesSpawner._docker is None:
+            try:
+                import docker
+            except ImportError:
+                raise Exception('The docker package is not installed and is a dependency for DockerProfilesSpawner')
+            DockerProfilesSpawner._docker = docker
+        return DockerProfilesSpawner._docker
+
+    # docker client shared by all instances, so that each listing does not open a new one
+    _docker_client = None
+
+    def _get_docker_client(self):
+        if DockerProfilesSpawner._docker_client is None:
+            DockerProfilesSpawner._docker_client = self._docker_module().from_env()
+        return DockerProfilesSpawner._docker_client
+
     def _jupyterhub_docker_tags(self):
-        try:
-            include_jh_tags = lambda tag: self.jupyterhub_docker_tag_re.match(tag)
-            return filter(include_jh_tags, [tag for image in docker.from_env().images.list() for tag in image.tags])
-        except NameError:
-            raise Exception('The docker package is not installed and is a dependency for DockerProfilesSpawner')
+        # The low-level API returns the tags in the listing itself, whereas images.list()
+        # inspects every image in a separate request
+        images = self._get_docker_client().api.images(filters={'dangling': False})
+        tags = (
+            tag for image in images for tag in (image.get('RepoTags') or ())
+            if tag != '<none>:<none>'
+        )
+        if self.jupyterhub_docker_tag_re is DockerProfilesSpawner.jupyterhub_docker_tag_re:
+            # the default pattern only checks for a literal suffix
+            return (tag for tag in tags if tag.endswith('jupyterhub'))
+        match = self.jupyterhub_docker_tag_re.match
+        return (tag for tag in tags if match(tag))
+
+    def _docker_profiles(self, tags=None):
+        if tags is None:
+            tags = self._jupyterhub_docker_tags()
+        nvidia_args = self._nvidia_args()
+        return [self._docker_profile(nvidia_args, tag) for tag in tags]
 
-    def _docker_profiles(self):
-        return [self._docker_profile(self._nvidia_args(), tag) for tag in self._jupyterhub_docker_tags()]
+    # (timestamp, profiles) of the last docker profile discovery
+    _profiles_cache = None
 
     @property
     def profiles(self):
-        return self.default_profiles + self._docker_profiles()
+        if self._profiles_cache is not None:
+            timestamp, profiles = self._profiles_cache
+            if time.monotonic() - timestamp < self.profiles_cache_ttl:
+                return profiles
+        return self._update_profiles()
+
+    def _update_profiles(self, tags=None):
+        profiles = self.default_profiles + self._docker_profiles(tags)
+        self._profiles_cache = (time.monotonic(), profiles)
+        return profiles
+
+    # (profiles list, index) for the cached docker profiles
+    _profile_index = None
+
+    def _get_profile_index(self):
+        # the cached profile list is never changed in place, only replaced on refresh,
+        # so the index stays valid for as long as it was built from the current list
+        profiles = self.profiles
+        if self._profile_index is None or self._profile_index[0] is not profiles:
+            self._profile_index = (profiles, {key: (cls, conf) for _, key, cls, conf in profiles})
+        return self._profile_index[1]
+
+    # docker forms churn with the image set, so keep them apart from the static profile forms
+    _form_cache = OrderedDict()
 
     @property
     def options_form(self):
-        temp_keys = [ dict(display=p[0], key=p[1], type=p[2], first='') for p in self.profiles]
-        temp_keys[0]['first'] = self.first_template
-        text = ''.join([ self.input_template.format(**tk) for tk in temp_keys ])
-        return self.form_template.format(input_template=text)
+        return self._render_options_form(list(self._jupyterhub_docker_tags()))
+
+    async def get_options_form(self):
+        # List images in a worker thread and query nvidia-docker asynchronously, so that
+        # rendering the form does not stall the Hub's event loop
+        loop = asyncio.get_running_loop()
+        tags, _ = await asyncio.gather(
+            loop.run_in_executor(None, lambda: list(self._jupyterhub_docker_tags())),
+            self._async_nvidia_args(),
+        )
+        return self._render_options_form(tags)
+
+    def _render_options_form(self, tags):
+        # Keep the profiles in step with the images offered in the form
+        return self._cached_form(self._update_profiles(tags))
 
 
 # vim: set ai expandtab softtabstop=4: